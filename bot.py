@@ -2,10 +2,18 @@ import discord
 import asyncio
 import openai
 import os
-import time
-import json # Added for persistence
+import re
+import sys
+import orjson # Fast JSON (de)serialization for persistence
+from pathlib import Path
 import logging # Added for better logging
+import atexit # Final flush of thread data on shutdown
+from collections import OrderedDict
 from dotenv import load_dotenv # Import the library
+try:
+    import uvloop # Faster drop-in event loop (optional, not available on Windows)
+except ImportError:
+    uvloop = None
 
 # --- Load Configuration ---
 load_dotenv() # Load variables from .env file into environment
@@ -16,38 +24,88 @@ ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 
 # --- Persistence Setup (JSON Method) ---
 THREAD_DATA_FILE = "user_threads_data.json"
-user_threads = {} # Global dictionary for thread IDs (will be loaded)
+# Global user -> thread ID mapping (will be loaded). Kept in least-recently-used
+# order so it can be capped at MAX_USER_THREADS entries.
+MAX_USER_THREADS = 50_000
+user_threads = OrderedDict()
 
 def load_threads():
     """Loads the user_threads dictionary from the JSON file."""
     global user_threads
     try:
-        with open(THREAD_DATA_FILE, 'r') as f:
-            # Load data, converting string keys back to integer user IDs
-            data_from_file = json.load(f)
-            user_threads = {int(k): v for k, v in data_from_file.items()}
-            logging.info(f"Loaded {len(user_threads)} user threads from {THREAD_DATA_FILE}")
+        # Load data, converting string keys back to integer user IDs
+        data_from_file = orjson.loads(Path(THREAD_DATA_FILE).read_bytes())
+        user_threads = OrderedDict((int(k), v) for k, v in data_from_file.items())
+        logging.info(f"Loaded {len(user_threads)} user threads from {THREAD_DATA_FILE}")
     except FileNotFoundError:
         logging.warning(f"{THREAD_DATA_FILE} not found. Starting with empty threads.")
-        user_threads = {}
-    except json.JSONDecodeError:
+        user_threads = OrderedDict()
+    except orjson.JSONDecodeError:
         logging.error(f"Error decoding JSON from {THREAD_DATA_FILE}. Starting with empty threads.")
-        user_threads = {} # Or potentially load a backup
+        user_threads = OrderedDict() # Or potentially load a backup
     except Exception as e:
         logging.error(f"An unexpected error occurred loading threads: {e}")
-        user_threads = {}
-
-def save_threads():
-    """Saves the current user_threads dictionary to the JSON file."""
-    global user_threads
+        user_threads = OrderedDict()
+
+# Writes are debounced: save_threads() only marks the data dirty and a background
+# task coalesces bursts of changes into a single write off the event loop.
+THREAD_SAVE_INTERVAL = 2.0 # Seconds to wait for more changes before writing
+_threads_dirty = False
+_save_event = asyncio.Event()
+_flusher_task = None
+
+def _serialize_threads():
+    """Snapshots user_threads as compact JSON bytes and clears the dirty flag."""
+    global _threads_dirty
+    _threads_dirty = False # Clear first so changes made after the snapshot trigger another write
+    # Convert integer keys to strings for JSON compatibility
+    return orjson.dumps({str(k): v for k, v in user_threads.items()})
+
+def _sync_write_threads(data, fsync=False):
+    """Writes serialized thread data to the JSON file (blocking); returns True on success.
+
+    Writes go to a temp file that is then renamed over the real one, so a crash
+    mid-write never leaves a truncated file. fsync is only needed on shutdown.
+    """
+    global _threads_dirty
+    tmp_file = THREAD_DATA_FILE + ".tmp"
     try:
-        with open(THREAD_DATA_FILE, 'w') as f:
-            # Convert integer keys to strings for JSON compatibility
-            data_to_save = {str(k): v for k, v in user_threads.items()}
-            json.dump(data_to_save, f, indent=4) # Use indent for readability
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_file, THREAD_DATA_FILE) # Atomic on POSIX and Windows
         # logging.debug("User threads saved.") # Optional debug log
+        return True
     except Exception as e:
+        _threads_dirty = True # Keep the data marked; the flusher schedules a retry
         logging.error(f"Error saving threads to {THREAD_DATA_FILE}: {e}")
+        return False
+
+def save_threads():
+    """Marks user_threads as changed; the background flusher writes it to disk."""
+    global _threads_dirty
+    _threads_dirty = True
+    _save_event.set()
+
+async def _thread_flusher():
+    """Background task that coalesces save_threads() calls into periodic writes."""
+    while True:
+        await _save_event.wait()
+        await asyncio.sleep(THREAD_SAVE_INTERVAL) # Let further changes pile up
+        _save_event.clear()
+        if _threads_dirty:
+            # Serialize on the loop so the worker thread never sees the dict mid-update
+            if not await asyncio.to_thread(_sync_write_threads, _serialize_threads()):
+                _save_event.set() # Retry after the next interval instead of waiting for a new change
+
+def flush_threads():
+    """Writes pending thread changes synchronously (used on shutdown)."""
+    if _threads_dirty:
+        _sync_write_threads(_serialize_threads(), fsync=True)
+
+atexit.register(flush_threads)
 
 # --- Logging Setup ---
 # Replace print statements with logging for better control
@@ -56,15 +114,51 @@ logger = logging.getLogger('discord_bot') # Optional: Use a specific logger name
 
 # --- OpenAI Client Setup ---
 # Check if the API key is still the placeholder (basic check)
-if OPENAI_API_KEY.startswith("sk-proj-") is False or OPENAI_API_KEY == "": # Slightly better check
+if not OPENAI_API_KEY or not OPENAI_API_KEY.startswith(("sk-", "sk-proj-")): # OpenAI uses several key prefixes
     logger.critical("OpenAI API key appears invalid or not configured. Please check the OPENAI_API_KEY variable.")
     exit()
 try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY) # Async client so API calls don't block the event loop
 except Exception as e:
     logger.critical(f"Failed to initialize OpenAI client: {e}")
     exit()
 
+# Cap how many messages are being processed against OpenAI at the same time
+MAX_CONCURRENT_REQUESTS = 8
+_openai_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+RUN_TIMEOUT_SECONDS = 120 # Generous timeout for potentially long runs
+
+async def _stream_run(client, thread_id, assistant_id, timeout=RUN_TIMEOUT_SECONDS):
+    """Runs the assistant on the thread via the streaming API instead of polling.
+
+    Returns (run, texts) where texts holds the text of each assistant message the
+    run produced, or (None, []) if it timed out (a cancel is attempted).
+    """
+    assistant_responses = []
+    async with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id) as stream:
+        async def consume_events():
+            add_response = assistant_responses.append # Bound once, this loop sees every event of the run
+            async for event in stream:
+                if event.event == "thread.message.completed" and event.data.role == "assistant":
+                    for content_block in event.data.content:
+                        if content_block.type == 'text':
+                            add_response(content_block.text.value)
+
+        try:
+            await asyncio.wait_for(consume_events(), timeout)
+        except asyncio.TimeoutError:
+            run = stream.current_run
+            logger.warning(f"Run {run.id if run else '(not started)'} timed out waiting for completion.")
+            if run:
+                try:
+                    await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                    logger.info("Attempted to cancel timed-out run %s", run.id)
+                except Exception as cancel_err:
+                    logger.error(f"Failed to cancel timed-out run {run.id}: {cancel_err}")
+            return None, []
+        return await stream.get_final_run(), assistant_responses
+
 
 # --- Discord Bot Setup ---
 intents = discord.Intents.default()
@@ -73,185 +167,276 @@ intents.message_content = True
 intents.dm_messages = True # Ensure DMs are enabled
 
 discord_client = discord.Client(intents=intents)
+# Per-message lookups of the bot's identity, filled in by setup_hook right after login
+_BOT_ID = None
+_MENTION_RE = None # Matches <@BOT_ID> and <@!BOT_ID>
+_BOT_ID_STR = None # Substring shared by both mention forms, for a cheap pre-check
+
+# --- Assistant Request Handling ---
+def _chunks(s, n=1990):
+    """Lazily yields n-character slices of s (leaves headroom under Discord's 2000 limit)."""
+    return (s[i:i+n] for i in range(0, len(s), n))
+
+EMBED_TEXT_LIMIT = 4000 # Embed descriptions allow 4096 characters; keep some headroom
+
+def _can_embed(channel):
+    """Whether embeds sent by the bot will show up in the channel (always true in DMs)."""
+    guild = getattr(channel, "guild", None)
+    return guild is None or channel.permissions_for(guild.me).embed_links
+
+async def _send_long(channel, prefix, text):
+    """Sends prefix + text to the channel as a single message where possible.
+
+    Text that doesn't fit in a plain message but fits in an embed is sent as one
+    embed (with the prefix as the message content) if the bot may embed links in
+    the channel; otherwise, and for longer text, it is split.
+    """
+    if len(text) + len(prefix) <= 2000: # Check the length without building the combined string
+        await channel.send(prefix + text)
+    elif len(text) <= EMBED_TEXT_LIMIT and _can_embed(channel):
+        await channel.send(prefix or None, embed=discord.Embed(description=text))
+    else:
+        if prefix:
+            await channel.send(prefix) # Send mention first
+        for part in _chunks(text): # discord.py already handles per-channel rate limits
+            await channel.send(part)
+
+async def _delete_openai_thread(thread_id):
+    """Tries to delete a thread on OpenAI's side, logging (not raising) failures."""
+    logger.info("Attempting to delete OpenAI thread: %s", thread_id)
+    try:
+        delete_status = await client.beta.threads.delete(thread_id)
+        if delete_status.deleted:
+            logger.info("Successfully deleted OpenAI thread %s.", thread_id)
+        else:
+            # This status might not always be accurate, log deletion attempt anyway
+            logger.warning(f"OpenAI API attempt to delete thread {thread_id} completed (Status: {delete_status}). Deletion might still occur.")
+    except openai.NotFoundError:
+        logger.warning(f"OpenAI thread {thread_id} was already deleted or not found.")
+    except Exception as delete_error:
+        logger.error(f"Failed to delete OpenAI thread {thread_id}: {delete_error}")
+
+_background_tasks = set() # Strong references so fire-and-forget tasks aren't garbage collected
+
+def _remember_thread(user_id, thread_id):
+    """Stores a new user -> thread mapping, evicting the least recently used past MAX_USER_THREADS."""
+    user_threads[user_id] = thread_id
+    while len(user_threads) > MAX_USER_THREADS:
+        old_user_id, old_thread_id = user_threads.popitem(last=False)
+        logger.info("Evicting thread %s of least recently active user %s.", old_thread_id, old_user_id)
+        task = asyncio.create_task(_delete_openai_thread(old_thread_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    save_threads() # <<< SAVE after adding to dict
+
+async def _reset_thread(user_id):
+    """Drops the user's thread mapping and tries to delete the thread on OpenAI's side."""
+    problematic_thread_id = user_threads.get(user_id) # Get the ID before removing mapping
+
+    # 1. Remove the thread mapping locally & save persistence
+    if user_id in user_threads:
+        del user_threads[user_id]
+        save_threads() # Save the updated dict (crucial for JSON method)
+        logger.info("Removed thread mapping for user %s from persistence.", user_id)
+    else:
+        logger.warning(f"Attempted to reset thread for user {user_id}, but they weren't in the user_threads dict.")
 
-@discord_client.event
-async def on_ready():
-    logger.info(f'Logged in as {discord_client.user.name} ({discord_client.user.id})')
-    logger.info('Assistant bot ready for DMs and Server Mentions.')
-    logger.info('------')
-
-@discord_client.event
-async def on_message(message: discord.Message): # Added type hint
-    # 1. Ignore messages from the bot itself
-    if message.author == discord_client.user:
+    # 2. (Optional but Recommended) Try to delete the thread on OpenAI's side
+    if problematic_thread_id:
+        await _delete_openai_thread(problematic_thread_id)
+    else:
+        logger.warning(f"Could not attempt OpenAI thread deletion because thread ID was missing for user {user_id} during reset.")
+
+# Per-user serialization: a thread can only have one active run, so a user's
+# messages are processed one at a time, with at most MAX_PENDING_PER_USER waiting.
+MAX_PENDING_PER_USER = 5
+_user_locks = {} # user_id -> asyncio.Lock, removed once the user has nothing pending
+_user_pending = {} # user_id -> number of requests running or waiting on the lock
+
+async def _handle_assistant_request(message: discord.Message, content: str, reply_prefix: str):
+    """Runs the user's message through the Assistant and replies in the same channel.
+
+    Shared by DMs and server mentions; reply_prefix is prepended to every reply
+    (empty in DMs, the author's mention in servers).
+    """
+    user_id = message.author.id
+    pending = _user_pending.get(user_id, 0)
+    if pending >= MAX_PENDING_PER_USER:
+        logger.warning(f"Dropping message from user {user_id}: {pending} requests already pending.")
+        await message.channel.send(f"{reply_prefix}I'm still working on your previous messages. Please wait for my reply before sending more.")
         return
 
-    user_id = message.author.id # Get user_id early for logging/use
-
-    # ----------------------------------------------------
-    # 2. Handle Direct Messages (DMs)
-    # ----------------------------------------------------
-    if message.guild is None:
-        logger.info(f"Received DM from {message.author} ({user_id}): {message.content[:50]}...") # Log start of message
-
+    _user_pending[user_id] = pending + 1
+    lock = _user_locks.setdefault(user_id, asyncio.Lock())
+    try:
+        async with lock:
+            await _process_assistant_request(message, content, reply_prefix)
+    finally:
+        _user_pending[user_id] -= 1
+        if not _user_pending[user_id]: # Nobody holds or waits on the lock, drop it
+            del _user_pending[user_id]
+            del _user_locks[user_id]
+
+async def _process_assistant_request(message: discord.Message, content: str, reply_prefix: str):
+    """Does the actual thread/run/reply work; callers must hold the user's lock."""
+    user_id = message.author.id
+    source = "DM" if message.guild is None else f"server {message.guild.id}" # For log messages
+
+    async with _openai_semaphore:
         async with message.channel.typing():
             try:
-                # --- Assistant Logic for DMs ---
-
-                # 1. Get or Create Thread for the User
+                # 1. Get or Create Thread for the User (shared between DMs and servers)
                 thread_id = user_threads.get(user_id) # Check cache first
                 if not thread_id:
-                    logger.info(f"Creating new thread for user {user_id} (triggered by DM)")
+                    logger.info("Creating new thread for user %s (triggered by %s)", user_id, source)
                     try:
-                        thread = client.beta.threads.create()
-                        user_threads[user_id] = thread.id
+                        thread = await client.beta.threads.create()
                         thread_id = thread.id
-                        save_threads() # <<< SAVE after adding to dict
-                        logger.info(f"Thread created with ID: {thread_id} and saved.")
+                        _remember_thread(user_id, thread_id)
+                        logger.info("Thread created with ID: %s and saved.", thread_id)
                     except Exception as api_error:
-                        logger.error(f"Failed to create OpenAI thread for DM user {user_id}: {api_error}")
-                        await message.channel.send("Sorry, I couldn't initiate our conversation context. Please try again later.")
+                        logger.error(f"Failed to create OpenAI thread for user {user_id} ({source}): {api_error}")
+                        await message.channel.send(f"{reply_prefix}Sorry, I couldn't initiate our conversation context. Please try again later.")
                         return
                 else:
-                    logger.debug(f"Using existing thread {thread_id} for user {user_id}")
-
+                    user_threads.move_to_end(user_id) # Mark as most recently used
+                    logger.debug("Using existing thread %s for user %s", thread_id, user_id)
 
                 # 2. Add User's Message to the Thread
-                logger.debug(f"Adding message to thread {thread_id}")
-                client.beta.threads.messages.create(
+                if logger.isEnabledFor(logging.DEBUG): # Skip slicing the content when not logged
+                    logger.debug("Adding message '%s...' to thread %s", content[:50], thread_id)
+                await client.beta.threads.messages.create(
                     thread_id=thread_id,
                     role="user",
-                    content=message.content # Use direct message content for DMs
+                    content=content
                 )
 
-                # 3. Run the Assistant on the Thread
-                logger.debug(f"Running assistant {ASSISTANT_ID} on thread {thread_id}")
-                run = client.beta.threads.runs.create(
-                    thread_id=thread_id,
-                    assistant_id=ASSISTANT_ID,
-                )
+                # 3. Run the Assistant on the Thread (events are pushed to us as the run progresses)
+                logger.debug("Streaming assistant %s run on thread %s", ASSISTANT_ID, thread_id)
+                run, assistant_responses = await _stream_run(client, thread_id, ASSISTANT_ID)
+                if run is None:
+                    await message.channel.send(f"{reply_prefix}Sorry, the request took too long to process. Please try again.")
+                    return # Exit processing for this message
 
-                # 4. Poll for Run Completion
-                logger.debug(f"Polling run {run.id} status...")
-                start_time = time.time()
-                timeout_seconds = 120 # Increased timeout for potentially long runs
-
-                while run.status in ['queued', 'in_progress', 'cancelling']:
-                    await asyncio.sleep(1.5) # Slightly longer sleep
-                    run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                    # logger.debug(f"Run status: {run.status}") # Can be noisy
-                    if time.time() - start_time > timeout_seconds:
-                         logger.warning(f"Run {run.id} timed out waiting for completion.")
-                         # Optionally try to cancel the run
-                         try:
-                             client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                             logger.info(f"Attempted to cancel timed-out run {run.id}")
-                         except Exception as cancel_err:
-                             logger.error(f"Failed to cancel timed-out run {run.id}: {cancel_err}")
-                         await message.channel.send("Sorry, the request took too long to process. Please try again.")
-                         return # Exit processing for this message
-
-                # 5. Retrieve and Send Response TO THE DM CHANNEL
+                # 4. Send Response to the originating channel
                 if run.status == 'completed':
-                    logger.debug(f"Run {run.id} completed. Fetching messages...")
-                    messages_response = client.beta.threads.messages.list(
-                        thread_id=thread_id,
-                        order="asc" # Get messages in chronological order
-                    )
-                    assistant_responses = []
-                    # Filter for messages from this specific run, most recent first
-                    for msg in reversed(messages_response.data):
-                        if msg.run_id == run.id and msg.role == "assistant":
-                            for content_block in msg.content:
-                                if content_block.type == 'text':
-                                    assistant_responses.append(content_block.text.value)
-                        # Optimization: Stop searching older messages once we hit a user message
-                        # that wasn't part of *this* run (heuristic)
-                        if msg.role == "user" and msg.run_id != run.id: # Check if run_id is None or different
-                            break
-
                     # --- Check if we got a response ---
                     if assistant_responses:
                         # --- SUCCESS CASE ---
-                        full_response = "\n".join(reversed(assistant_responses)) # Reverse back to correct order
-                        logger.info(f"Sending Assistant Response to DM user {user_id}")
-
-                        # --- Send response (Handle long messages for DM) ---
-                        if len(full_response) <= 2000:
-                           await message.channel.send(full_response)
-                        else:
-                            parts = [full_response[i:i+1990] for i in range(0, len(full_response), 1990)]
-                            for part in parts:
-                                await message.channel.send(part)
-                                await asyncio.sleep(0.5) # Small delay between parts
-                         # --- End of Success Case ---
+                        full_response = "\n".join(assistant_responses)
+                        logger.info("Sending Assistant Response to %s (%s)", message.author, source)
+                        await _send_long(message.channel, reply_prefix, full_response)
 
                     else:
                         # --- FAILURE CASE: No response text found -> Reset Thread ---
-                        logger.warning(f"No response text found from assistant for run {run.id}. Resetting thread for user {user_id} in DM.")
-
-                        problematic_thread_id = user_threads.get(user_id) # Get the ID before removing mapping
-
-                        # 1. Remove the thread mapping locally & save persistence
-                        if user_id in user_threads:
-                            del user_threads[user_id]
-                            save_threads() # Save the updated dict (crucial for JSON method)
-                            logger.info(f"Removed thread mapping for user {user_id} from persistence.")
-                        else:
-                            logger.warning(f"Attempted to reset thread for user {user_id}, but they weren't in the user_threads dict.")
-
-                        # 2. (Optional but Recommended) Try to delete the thread on OpenAI's side
-                        if problematic_thread_id:
-                            logger.info(f"Attempting to delete problematic OpenAI thread: {problematic_thread_id}")
-                            try:
-                                # Make sure 'client' is your initialized OpenAI client
-                                delete_status = client.beta.threads.delete(problematic_thread_id)
-                                if delete_status.deleted:
-                                    logger.info(f"Successfully deleted OpenAI thread {problematic_thread_id}.")
-                                else:
-                                     # This status might not always be accurate, log deletion attempt anyway
-                                     logger.warning(f"OpenAI API attempt to delete thread {problematic_thread_id} completed (Status: {delete_status}). Deletion might still occur.")
-                            except openai.NotFoundError:
-                                logger.warning(f"OpenAI thread {problematic_thread_id} was already deleted or not found.")
-                            except Exception as delete_error:
-                                logger.error(f"Failed to delete OpenAI thread {problematic_thread_id}: {delete_error}")
-                        else:
-                             logger.warning(f"Could not attempt OpenAI thread deletion because thread ID was missing for user {user_id} during reset.")
-
-                        # 3. Inform the user
-                        # No mention needed in DMs
-                        await message.channel.send("I seemed to have trouble retrieving the last response, so I've reset our conversation context. Please try sending your message again!")
-                        # --- End of Reset Logic ---
+                        logger.warning(f"No response text found from assistant for run {run.id}. Resetting thread for user {user_id} ({source}).")
+                        await _reset_thread(user_id)
+                        await message.channel.send(f"{reply_prefix}I seemed to have trouble retrieving the last response, so I've reset our conversation context. Please try sending your message again!")
 
                 elif run.status == 'requires_action':
                     logger.warning(f"Run {run.id} requires action (not supported): {run.required_action}")
-                    await message.channel.send("Sorry, I need to perform an action I can't do right now.")
+                    await message.channel.send(f"{reply_prefix}Sorry, I need to perform an action I can't do right now.")
                     # Note: You would handle function calls here if your assistant uses them.
                 elif run.status == 'failed':
-                     logger.error(f"Run {run.id} failed. Last Error: {run.last_error}")
-                     # Provide a more specific error if possible
-                     error_message = "Sorry, something went wrong while processing."
-                     if run.last_error:
-                         error_message += f" (Error code: {run.last_error.code})"
-                     await message.channel.send(error_message)
+                    logger.error(f"Run {run.id} failed. Last Error: {run.last_error}")
+                    # Provide a more specific error if possible
+                    error_message = f"{reply_prefix}Sorry, something went wrong while processing."
+                    if run.last_error:
+                        error_message += f" (Error code: {run.last_error.code})"
+                    await message.channel.send(error_message)
                 else: # 'cancelled', 'expired'
                     logger.error(f"Run {run.id} ended with unhandled status: {run.status}")
-                    await message.channel.send(f"Sorry, the processing ended unexpectedly. (Status: {run.status})")
+                    await message.channel.send(f"{reply_prefix}Sorry, the processing ended unexpectedly. (Status: {run.status})")
 
             except openai.RateLimitError:
-                logger.warning(f"OpenAI Rate Limit hit for user {user_id} in DM.")
-                await message.channel.send("I'm experiencing high demand right now. Please wait a moment and try again.")
+                logger.warning(f"OpenAI Rate Limit hit for user {user_id} ({source}).")
+                await message.channel.send(f"{reply_prefix}I'm experiencing high demand right now. Please wait a moment and try again.")
             except openai.APIError as api_err:
-                 logger.error(f"OpenAI API Error processing DM for {user_id}: {api_err}")
-                 await message.channel.send("There was an issue communicating with the AI service. Please try again later.")
+                logger.error(f"OpenAI API Error processing message from {user_id} ({source}): {api_err}")
+                await message.channel.send(f"{reply_prefix}There was an issue communicating with the AI service. Please try again later.")
             except Exception as e:
-                logger.exception(f"Unexpected error processing DM from {user_id}: {e}") # Log full traceback
-                await message.channel.send("Sorry, I encountered an unexpected error trying to process your DM.")
+                logger.exception(f"Unexpected error processing message from {user_id} ({source}): {e}") # Log full traceback
+                await message.channel.send(f"{reply_prefix}Sorry, I encountered an unexpected error trying to process that.")
+
+async def _validate_assistant():
+    """Checks that ASSISTANT_ID can be retrieved; returns False (after logging why) if not."""
+    try:
+        await client.beta.assistants.retrieve(ASSISTANT_ID)
+        logger.info(f"Successfully retrieved Assistant {ASSISTANT_ID}")
+        return True
+    except openai.AuthenticationError:
+        logger.critical(f"ERROR: OpenAI Authentication Error. Is the API key ({OPENAI_API_KEY[:6]}...) correct and valid?")
+    except openai.NotFoundError:
+        logger.critical(f"ERROR: Could not find Assistant {ASSISTANT_ID}. Is the ID correct?")
+    except Exception as e:
+        logger.critical(f"ERROR: Could not retrieve Assistant {ASSISTANT_ID}. Unexpected error: {e}")
+    return False
+
+_assistant_check = None # Started in setup_hook; messages are ignored until it has succeeded
+
+def _assistant_validated():
+    """True once the Assistant check has finished successfully."""
+    return (_assistant_check is not None and _assistant_check.done()
+            and not _assistant_check.cancelled() and _assistant_check.result())
+
+def _on_assistant_checked(task):
+    """Shuts the bot down as soon as the Assistant check fails."""
+    if task.cancelled(): # Bot is already shutting down (Ctrl-C or close)
+        return
+    if not task.result():
+        logger.critical("Shutting down: the configured Assistant could not be validated.")
+        close_task = asyncio.create_task(discord_client.close())
+        _background_tasks.add(close_task)
+        close_task.add_done_callback(_background_tasks.discard)
+
+@discord_client.event
+async def setup_hook():
+    # Runs after login but before the gateway connects, so the assistant lookup
+    # overlaps with the connection instead of delaying startup
+    global _assistant_check, _BOT_ID, _MENTION_RE, _BOT_ID_STR, _flusher_task
+    _assistant_check = asyncio.create_task(_validate_assistant())
+    _assistant_check.add_done_callback(_on_assistant_checked)
+    # Messages can be served as soon as the check passes, possibly before on_ready
+    _flusher_task = asyncio.create_task(_thread_flusher())
+    # discord_client.user is known once logged in; no messages arrive before this point
+    _BOT_ID = discord_client.user.id
+    _MENTION_RE = re.compile(rf'<@!?{_BOT_ID}>')
+    _BOT_ID_STR = str(_BOT_ID)
+
+@discord_client.event
+async def on_ready():
+    logger.info(f'Logged in as {discord_client.user.name} ({_BOT_ID})')
+    logger.info('Assistant bot ready for DMs and Server Mentions.')
+    logger.info('------')
+
+@discord_client.event
+async def on_message(message: discord.Message): # Added type hint
+    # 1. Ignore messages from the bot itself
+    if message.author.id == _BOT_ID:
+        return
+
+    # Don't serve anything until the Assistant has been validated (or if validation failed)
+    if not _assistant_validated():
+        return
+
+    user_id = message.author.id # Get user_id early for logging/use
+
+    # ----------------------------------------------------
+    # 2. Handle Direct Messages (DMs)
+    # ----------------------------------------------------
+    if message.guild is None:
+        logger.info("Received DM from %s (%s): %s...", message.author, user_id, message.content[:50]) # Log start of message
+        await _handle_assistant_request(message, message.content, reply_prefix="") # No mention needed in DMs
 
     # ----------------------------------------------------
     # 3. Handle Server Messages (Guild Messages)
     # ----------------------------------------------------
     else:
+        # Fast path for the common case: no mention of the bot in the text and not a reply
+        # (replies can ping the bot without the mention appearing in the content)
+        if _BOT_ID_STR not in message.content and message.reference is None:
+            return
+
         # Check if the bot was mentioned in the server message
         if discord_client.user.mentioned_in(message):
 
@@ -259,19 +444,11 @@ async def on_message(message: discord.Message): # Added type hint
                 logger.debug("Ignoring message with @everyone/@here mention.")
                 return
 
-            guild_id = message.guild.id
-            channel_id = message.channel.id
-            # user_id is already defined above
-
-            logger.info(f"Received mention in Server '{message.guild.name}', Channel '{message.channel.name}' from {message.author}")
+            logger.info("Received mention in Server '%s', Channel '%s' from %s", message.guild.name, message.channel.name, message.author)
 
             # Clean the message content to remove the bot's mention
-            # Handle both <@USER_ID> and <@!USER_ID> formats
-            mention_patterns = [f'<@!{discord_client.user.id}>', f'<@{discord_client.user.id}>']
-            actual_content = message.content
-            for pattern in mention_patterns:
-                actual_content = actual_content.replace(pattern, '')
-            actual_content = actual_content.strip()
+            # Handle both <@USER_ID> and <@!USER_ID> formats in a single pass
+            actual_content = _MENTION_RE.sub('', message.content).strip()
 
 
             # --- Check for 'dm' command --- (Optional - Placeholder if not used)
@@ -287,161 +464,19 @@ async def on_message(message: discord.Message): # Added type hint
                 return
 
             # Process the request using the Assistant API
-            async with message.channel.typing():
-                try:
-                    # 1. Get or Create Thread for the User (shared with DMs)
-                    thread_id = user_threads.get(user_id) # Check cache first
-                    if not thread_id:
-                        logger.info(f"Creating new thread for user {user_id} (triggered by server mention)")
-                        try:
-                            thread = client.beta.threads.create()
-                            user_threads[user_id] = thread.id
-                            thread_id = thread.id
-                            save_threads() # <<< SAVE after adding to dict
-                            logger.info(f"Thread created with ID: {thread_id} and saved.")
-                        except Exception as api_error:
-                            logger.error(f"Failed to create OpenAI thread for user {user_id} (server mention): {api_error}")
-                            await message.channel.send(f"{message.author.mention} Sorry, I couldn't initiate our conversation context. Please try again later.")
-                            return
-                    else:
-                         logger.debug(f"Using existing thread {thread_id} for user {user_id}")
-
-
-                    # 2. Add User's Message (the cleaned content) to the Thread
-                    logger.debug(f"Adding message '{actual_content[:50]}...' to thread {thread_id}")
-                    client.beta.threads.messages.create(
-                        thread_id=thread_id,
-                        role="user",
-                        content=actual_content # Use the cleaned content for server mentions
-                    )
-
-                    # 3. Run the Assistant on the Thread
-                    logger.debug(f"Running assistant {ASSISTANT_ID} on thread {thread_id}")
-                    run = client.beta.threads.runs.create(
-                        thread_id=thread_id,
-                        assistant_id=ASSISTANT_ID,
-                    )
-
-                    # 4. Poll for Run Completion (same as DMs with timeout)
-                    logger.debug(f"Polling run {run.id} status...")
-                    start_time = time.time()
-                    timeout_seconds = 120 # Increased timeout
-
-                    while run.status in ['queued', 'in_progress', 'cancelling']:
-                        await asyncio.sleep(1.5)
-                        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                        # logger.debug(f"Run status: {run.status}")
-                        if time.time() - start_time > timeout_seconds:
-                            logger.warning(f"Run {run.id} timed out waiting for completion (server mention).")
-                            try:
-                                client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                                logger.info(f"Attempted to cancel timed-out run {run.id}")
-                            except Exception as cancel_err:
-                                logger.error(f"Failed to cancel timed-out run {run.id}: {cancel_err}")
-                            await message.channel.send(f"{message.author.mention} Sorry, the request took too long to process. Please try again.")
-                            return
-
-                    # 5. Retrieve and Send Response TO THE SERVER CHANNEL
-                    if run.status == 'completed':
-                        logger.debug(f"Run {run.id} completed. Fetching messages...")
-                        messages_response = client.beta.threads.messages.list(
-                            thread_id=thread_id,
-                            order="asc"
-                        )
-                        assistant_responses = []
-                        for msg in reversed(messages_response.data):
-                            if msg.run_id == run.id and msg.role == "assistant":
-                                for content_block in msg.content:
-                                    if content_block.type == 'text':
-                                        assistant_responses.append(content_block.text.value)
-                            if msg.role == "user" and msg.run_id != run.id:
-                                break # Heuristic stop check
-
-                        # --- Check if we got a response ---
-                        if assistant_responses:
-                            # --- SUCCESS CASE ---
-                            full_response = "\n".join(reversed(assistant_responses))
-                            logger.info(f"Sending Assistant Response to {message.author.name} in channel {message.channel.name}")
-
-                            # --- Send response (Handle long messages for Server) ---
-                            response_prefix = f"{message.author.mention} "
-                            if len(response_prefix + full_response) <= 2000:
-                                await message.channel.send(response_prefix + full_response)
-                            else:
-                                # Handle long messages for Server
-                                await message.channel.send(response_prefix) # Send mention first
-                                parts = [full_response[i:i+1990] for i in range(0, len(full_response), 1990)]
-                                for part in parts:
-                                    await message.channel.send(part)
-                                    await asyncio.sleep(0.5) # Small delay between parts
-                            # --- End of Success Case ---
-
-                        else:
-                            # --- FAILURE CASE: No response text found -> Reset Thread ---
-                            logger.warning(f"No response text found from assistant for run {run.id}. Resetting thread for user {user_id} in server channel {channel_id}.")
-
-                            problematic_thread_id = user_threads.get(user_id) # Get the ID before removing mapping
-
-                            # 1. Remove the thread mapping locally & save persistence
-                            if user_id in user_threads:
-                                del user_threads[user_id]
-                                save_threads() # Save the updated dict (crucial for JSON method)
-                                logger.info(f"Removed thread mapping for user {user_id} from persistence.")
-                            else:
-                                logger.warning(f"Attempted to reset thread for user {user_id}, but they weren't in the user_threads dict.")
-
-                            # 2. (Optional but Recommended) Try to delete the thread on OpenAI's side
-                            if problematic_thread_id:
-                                logger.info(f"Attempting to delete problematic OpenAI thread: {problematic_thread_id}")
-                                try:
-                                    # Make sure 'client' is your initialized OpenAI client
-                                    delete_status = client.beta.threads.delete(problematic_thread_id)
-                                    if delete_status.deleted:
-                                        logger.info(f"Successfully deleted OpenAI thread {problematic_thread_id}.")
-                                    else:
-                                         logger.warning(f"OpenAI API attempt to delete thread {problematic_thread_id} completed (Status: {delete_status}). Deletion might still occur.")
-                                except openai.NotFoundError:
-                                    logger.warning(f"OpenAI thread {problematic_thread_id} was already deleted or not found.")
-                                except Exception as delete_error:
-                                    logger.error(f"Failed to delete OpenAI thread {problematic_thread_id}: {delete_error}")
-                            else:
-                                 logger.warning(f"Could not attempt OpenAI thread deletion because thread ID was missing for user {user_id} during reset.")
-
-                            # 3. Inform the user
-                            user_mention = f"{message.author.mention} " # Always mention in server
-                            await message.channel.send(f"{user_mention}I seemed to have trouble retrieving the last response, so I've reset our conversation context. Please try sending your message again!".strip())
-                            # --- End of Reset Logic ---
-
-
-                    elif run.status == 'requires_action':
-                        logger.warning(f"Run {run.id} requires action (not supported): {run.required_action}")
-                        await message.channel.send(f"{message.author.mention} Sorry, I need to perform an action I can't do right now.")
-                    elif run.status == 'failed':
-                        logger.error(f"Run {run.id} failed. Last Error: {run.last_error}")
-                        error_message = f"{message.author.mention} Sorry, something went wrong while processing."
-                        if run.last_error:
-                             error_message += f" (Error code: {run.last_error.code})"
-                        await message.channel.send(error_message)
-                    else: # includes 'cancelled', 'expired'
-                        logger.error(f"Run {run.id} ended with unhandled status: {run.status}")
-                        await message.channel.send(f"{message.author.mention} Sorry, the processing ended unexpectedly. (Status: {run.status})")
-
-                except openai.RateLimitError:
-                    logger.warning(f"OpenAI Rate Limit hit for user {user_id} in server {guild_id}.")
-                    await message.channel.send(f"{message.author.mention} I'm experiencing high demand right now. Please wait a moment and try again.")
-                except openai.APIError as api_err:
-                     logger.error(f"OpenAI API Error processing server mention for {user_id} in {guild_id}: {api_err}")
-                     await message.channel.send(f"{message.author.mention} There was an issue communicating with the AI service. Please try again later.")
-                except Exception as e:
-                    logger.exception(f"Unexpected error processing server mention from {user_id} in {guild_id}: {e}") # Log full traceback
-                    await message.channel.send(f"{message.author.mention} Sorry, I encountered an unexpected error trying to process that.")
+            await _handle_assistant_request(message, actual_content, reply_prefix=f"{message.author.mention} ") # Always mention in server
 
         # else: (Implicit) Message in server, bot not mentioned. Ignore silently.
 
 # --- Run the Bot ---
+async def _run_client():
+    """Starts the client and closes it on exit (what discord_client.run() does internally)."""
+    async with discord_client:
+        await discord_client.start(DISCORD_BOT_TOKEN)
+
 if __name__ == "__main__": # Use main guard
     # Basic validation before starting
-    if DISCORD_BOT_TOKEN.startswith("M") is False or DISCORD_BOT_TOKEN == "" or len(DISCORD_BOT_TOKEN) < 50: # Basic token format check
+    if not DISCORD_BOT_TOKEN or len(DISCORD_BOT_TOKEN) < 50: # Basic token format check (tokens don't always start with "M")
         logger.critical("Discord Bot Token appears invalid or not configured. Please check the DISCORD_BOT_TOKEN variable.")
         exit()
     if not ASSISTANT_ID.startswith("asst_"):
@@ -449,25 +484,26 @@ if __name__ == "__main__": # Use main guard
          exit()
 
     try:
-        # Validate Assistant ID exists before running
-        try:
-            client.beta.assistants.retrieve(ASSISTANT_ID)
-            logger.info(f"Successfully retrieved Assistant {ASSISTANT_ID}")
-        except openai.AuthenticationError:
-             logger.critical(f"ERROR: OpenAI Authentication Error. Is the API key ({OPENAI_API_KEY[:6]}...) correct and valid?")
-             exit()
-        except openai.NotFoundError:
-            logger.critical(f"ERROR: Could not find Assistant {ASSISTANT_ID}. Is the ID correct?")
-            exit()
-        except Exception as e:
-            logger.critical(f"ERROR: Could not retrieve Assistant {ASSISTANT_ID}. Unexpected error: {e}")
-            exit() # Exit if assistant validation fails
-
         # Load existing thread data before starting the client
         load_threads()
 
         logger.info("Starting Discord client...")
-        discord_client.run(DISCORD_BOT_TOKEN)
+        if uvloop is not None and sys.version_info >= (3, 12):
+            # uvloop.install() is deprecated here; run the client on a uvloop loop directly,
+            # doing what discord_client.run() would (logging setup, clean Ctrl-C exit)
+            logger.info("Using uvloop event loop.")
+            discord.utils.setup_logging(root=False)
+            try:
+                with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                    runner.run(_run_client())
+            except KeyboardInterrupt:
+                pass
+        else:
+            if uvloop is not None:
+                uvloop.install() # discord_client.run() will then create a uvloop event loop
+                logger.info("Using uvloop event loop.")
+            discord_client.run(DISCORD_BOT_TOKEN)
+        flush_threads() # Persist anything still pending once the client has shut down
 
     except discord.errors.LoginFailure:
         logger.critical("ERROR: Invalid Discord Token. Please check your DISCORD_BOT_TOKEN.")